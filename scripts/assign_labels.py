@@ -22,6 +22,7 @@ from __future__ import print_function
 import argparse
 import os
 from datetime import datetime
+from itertools import combinations
 
 import joblib as jl
 import numpy as np
@@ -136,12 +137,10 @@ def main():
     print(u'\u2713')
 
     # Sanity checks - for peace of mind -
-    assert(len(set(idx0).intersection(set(idx1))) == 0)
-    assert(len(set(idx0).intersection(set(idx2))) == 0)
-    assert(len(set(idx0).intersection(set(idx3))) == 0)
-    assert(len(set(idx1).intersection(set(idx2))) == 0)
-    assert(len(set(idx1).intersection(set(idx3))) == 0)
-    assert(len(set(idx2).intersection(set(idx3))) == 0)
+    # (build each set once and compare them with isdisjoint)
+    groups = [set(idx0), set(idx1), set(idx2), set(idx3)]
+    for g0, g1 in combinations(groups, 2):
+        assert(g0.isdisjoint(g1))
 
     # Save the labels
     ext = '.csv' if not args.output.endswith('.csv') else ''
@@ -87,8 +87,9 @@ def main():
     # however in this case it can be accepted as the vocabulary size is limited
     # to the number of MBS items and it is very unlikely that
     print('* Preparing data...', end=' ')
-    bow = CountVectorizer(ngram_range=(1, args.ngram),
-                          tokenizer=lambda x: x.split(' '))
+    bow = CountVectorizer(ngram_range=(1, args.ngram), lowercase=False,
+                          preprocessor=lambda x: x,  # already tokenized
+                          tokenizer=lambda x: x)
     xbow = bow.fit_transform(dataset['mbs_seq'])
     xbow = sp.sparse.csr_matrix(xbow / xbow.sum(axis=1))
     _dummy = np.empty((xbow.shape[0], 1))  # timespans not used in this case
@@ -9,10 +9,10 @@ and even entries are days between each visit.
 from __future__ import print_function
 
 import argparse
-import cPickle as pkl
 import os
 from datetime import datetime
 
+import joblib as jl
 import tangle.mbspbs10pc.raw_data_utils as utils
 from tangle.mbspbs10pc.utils import check_input
 
@@ -76,11 +76,12 @@ def main():
     print('[{}] Exclude pregnancy: {}'.format(*('+', 'ON') if args.exclude_pregnancy else (' ', 'OFF')))
     print('-------------------------------------------------------------------')
 
-    # MBS 10% dataset files
-    mbs_files = filter(lambda x: x.startswith('MBS'), os.listdir(args.root))
+    # MBS 10% dataset files (list the root folder only once)
+    root_files = os.listdir(args.root)
+    mbs_files = filter(lambda x: x.startswith('MBS'), root_files)
     mbs_files_fullpath = [os.path.join(args.root, mbs) for mbs in mbs_files]
     sample_pin_lookout = filter(lambda x: x.startswith('SAMPLE'),
-                                os.listdir(args.root))[0]
+                                root_files)[0]
 
     # Get the features
     filename = args.output+'_raw_data_.pkl'
@@ -89,9 +90,10 @@ def main():
                                       os.path.join(args.root,
                                                    sample_pin_lookout),
                                       exclude_pregnancy=args.exclude_pregnancy,
-                                      source=args.source)
+                                      source=args.source,
+                                      n_jobs=args.n_jobs)
         print('* Saving {} '.format(filename), end=' ')
-        pkl.dump(raw_data, open(filename, 'wb'))
+        jl.dump(raw_data, open(filename, 'wb'))
         print(u'\u2713')
 
 
@@ -39,6 +39,8 @@ def parse_arguments():
                         default=None)
     parser.add_argument('-sic', '--skip_input_check', action='store_false',
                         help='Skip the input check (default=False).')
+    parser.add_argument('-nj', '--n_jobs', type=int,
+                        help='The number of processes to use.', default=4)
     args = parser.parse_args()
     return args
 
@@ -68,59 +70,73 @@ def main():
 
     print('* Root data folder: {}'.format(args.root))
     print('* Output files: {}.[pkl, csv, ...]'.format(args.output))
+    print('* Number of jobs: {}'.format(args.n_jobs))
     print('-------------------------------------------------------------------')
 
     # PBS 10% dataset files
     pbs_files = filter(lambda x: x.startswith('PBS'), os.listdir(args.root))
     pbs_files_fullpath = [os.path.join(args.root, pbs) for pbs in pbs_files]
 
+    # The intermediate results are computed (or loaded) only if a later step
+    # needs them, i.e. if its own output file is missing
+    find_ccc = not os.path.exists(args.output+'_dd_.pkl')
+    find_conc = find_ccc and not os.path.exists(args.output+'_cc_.pkl')
+
     # --- STEP 1 --- #
     # Find the continuously concessionals (Condition #1)
-    filename = args.output+'_cont_.pkl'
-    if not os.path.exists(filename):
-        print('* Looking for continuously concessionals ...')
-        cont_conc = c_utils.find_continuously_concessionals(pbs_files_fullpath)
-        print('* Saving {} '.format(filename), end=' ')
-        jl.dump(cont_conc, open(filename, 'wb'))
-        print(u'\u2713')
-    else:
-        cont_conc = jl.load(open(filename, 'rb'))
-    print('* {} Subjects continuously use concessional cards'.format(len(cont_conc)))
+    if find_conc:
+        filename = args.output+'_cont_.pkl'
+        if not os.path.exists(filename):
+            print('* Looking for continuously concessionals ...')
+            cont_conc = c_utils.find_continuously_concessionals(
+                pbs_files_fullpath, n_jobs=args.n_jobs)
+            print('* Saving {} '.format(filename), end=' ')
+            jl.dump(cont_conc, open(filename, 'wb'))
+            print(u'\u2713')
+        else:
+            cont_conc = jl.load(open(filename, 'rb'))
+        print('* {} Subjects continuously use concessional '
+              'cards'.format(len(cont_conc)))
 
     # --- STEP 2 --- #
     # Filter out the subjects that are not using the concessional cards for at
     # least 50% of the times for each year (Condition #2)
-    filename = args.output+'_cons_.pkl'
-    if not os.path.exists(filename):
-        print('* Looking for consistently concessionals ...')
-        cons_conc = c_utils.find_consistently_concessionals(pbs_files_fullpath)
-        print('* Saving {} '.format(filename), end=' ')
-        jl.dump(cons_conc, open(filename, 'wb'))
-        print(u'\u2713')
-    else:
-        cons_conc = jl.load(open(filename, 'rb'))
-    print('* {} Subjects consistently use concessional cards'.format(len(cons_conc)))
+    if find_conc:
+        filename = args.output+'_cons_.pkl'
+        if not os.path.exists(filename):
+            print('* Looking for consistently concessionals ...')
+            cons_conc = c_utils.find_consistently_concessionals(
+                pbs_files_fullpath, n_jobs=args.n_jobs)
+            print('* Saving {} '.format(filename), end=' ')
+            jl.dump(cons_conc, open(filename, 'wb'))
+            print(u'\u2713')
+        else:
+            cons_conc = jl.load(open(filename, 'rb'))
+        print('* {} Subjects consistently use concessional '
+              'cards'.format(len(cons_conc)))
 
     # --- STEP 3 --- #
     # Intersect the two sets and get the consistently and continuous
     # concessional cards users
-    filename = args.output+'_cc_.pkl'
-    if not os.path.exists(filename):
-        ccc = cons_conc.intersection(cont_conc)
-        print('* Saving {} '.format(filename), end=' ')
-        jl.dump(ccc, open(filename, 'wb'))
-        print(u'\u2713')
-    else:
-        ccc = jl.load(open(filename, 'rb'))
-    print('* {} Subjects consistently AND continuously '
-          'use concessional cards'.format(len(ccc)))
+    if find_ccc:
+        filename = args.output+'_cc_.pkl'
+        if not os.path.exists(filename):
+            ccc = cons_conc.intersection(cont_conc)
+            print('* Saving {} '.format(filename), end=' ')
+            jl.dump(ccc, open(filename, 'wb'))
+            print(u'\u2713')
+        else:
+            ccc = jl.load(open(filename, 'rb'))
+        print('* {} Subjects consistently AND continuously '
+              'use concessional cards'.format(len(ccc)))
 
     # --- STEP 4 --- #
     # Find continuously and consistently concessional people on diabetic drugs
     filename = args.output+'_dd_.pkl'
     if not os.path.exists(filename):
         print('* Looking for subjects on diabete control drugs ...')
-        dd = d_utils.find_diabetics(pbs_files_fullpath, ccc)
+        dd = d_utils.find_diabetics(pbs_files_fullpath, ccc,
+                                    n_jobs=args.n_jobs)
         print('\n* Saving {} '.format(filename), end=' ')
         jl.dump(dd, open(filename, 'wb'))
         print(u'\u2713')
@@ -68,31 +68,33 @@ def main():
     labels = pd.read_csv(os.path.join(args.source, 'labels.csv'),
                          header=0, index_col=0)
 
-    # Init the empty CEM table
-    cem_table = pd.DataFrame(columns=['AVG_AGE', 'SEX', 'PINSTATE',
-                                      'SEQ_LENGTH', 'CLASS'],
-                             index=idx)
-
     # Define the PINSTATE map
     pinstate_map = {1.: 'ACT+NSW', 2.: 'VIC+TAS',
                     3.: 'NT+SA', 4.: 'QLD', 5.: 'WA'}
 
-    # Let's create the CEM table:
-    # 1. Apply the PINSTATE map
-    cem_table.loc[idx, 'PINSTATE'] = rd.loc[idx, 'last_pinstate'].map(lambda x: pinstate_map[x])
+    # Unknown PINSTATEs would be silently mapped to NaN: fail loudly instead
+    pinstate = rd['last_pinstate'].map(pinstate_map)
+    unknown = rd['last_pinstate'][pinstate.isnull().values]
+    if not unknown.empty:
+        raise KeyError('Unknown PINSTATE: {}'.format(sorted(unknown.unique())))
 
-    # 2. Extract sequence length
-    cem_table.loc[idx, 'SEQ_LENGTH'] = rd.loc[idx, 'seq'].apply(lambda x: len(x))
+    # Define the CLASS map
+    class_map = {'OTHER': -1, 'METONLY': 0, 'MET+X': 1, 'MET2X': 1}
 
+    # Let's create the CEM table from whole columns:
+    # 1. Use the mapped PINSTATE
+    # 2. Extract sequence length
     # 3. Get the average age
-    cem_table.loc[idx, 'AVG_AGE'] = rd.loc[idx, 'avg_age']
-
     # 4. Get gender
-    cem_table.loc[idx, 'SEX'] = rd.loc[idx, 'sex']
-
     # 5. Get the class label
-    class_map = {'OTHER': -1, 'METONLY': 0, 'MET+X': 1, 'MET2X': 1}
-    cem_table.loc[:, 'CLASS'] = labels.loc[idx, 'LABEL'].map(lambda x: class_map[x])
+    cem_table = pd.DataFrame({'AVG_AGE': rd['avg_age'],
+                              'SEX': rd['sex'],
+                              'PINSTATE': pinstate,
+                              'SEQ_LENGTH': rd['seq'].str.len(),
+                              'CLASS': labels.loc[idx, 'LABEL'].map(class_map)},
+                             columns=['AVG_AGE', 'SEX', 'PINSTATE',
+                                      'SEQ_LENGTH', 'CLASS'],
+                             index=idx)
     cem_table = cem_table.loc[cem_table['CLASS'] >= 0 ,:] # exclude others
     print('* n samples: {}'.format(cem_table.shape[0]))
 
@@ -12,6 +12,33 @@ def softmax(x, axis=-1):
     return ex / K.sum(ex, axis=axis, keepdims=True)
 
 
+def timestep_dot(x, kernel, n_timespans):
+    """Multiply each timestep of a 3D tensor by a 2D kernel.
+
+    The input is folded to 2D so that the product is a single matrix
+    multiplication (`K.dot` on 3D tensors also transposes the kernel).
+
+    Parameters:
+    --------------
+    x: tensor
+        Input tensor with shape=(batch_size, n_timespans, input_dim).
+
+    kernel: tensor
+        Weights with shape=(input_dim, units).
+
+    n_timespans: int
+        Number of timespans of the input tensor.
+
+    Returns:
+    --------------
+    out: tensor
+        Output tensor with shape=(batch_size, n_timespans, units).
+    """
+    input_dim, units = K.int_shape(kernel)
+    out = K.dot(K.reshape(x, (-1, input_dim)), kernel)
+    return K.reshape(out, (-1, n_timespans, units))
+
+
 class ConvexCombination(Layer):
     def __init__(self, **kwargs):
         super(ConvexCombination, self).__init__(**kwargs)
@@ -31,7 +58,8 @@ class ConvexCombination(Layer):
     def call(self, x):
         # x is a list of two tensors with
         # shape=(batch_size, recurrent_hidden_units, n_timespans)
-        return self.lambd * x[0] + (1 - self.lambd) * x[1]
+        # lambda * x0 + (1 - lambda) * x1 == x1 + lambda * (x0 - x1)
+        return x[1] + self.lambd * (x[0] - x[1])
 
     def compute_output_shape(self, input_shape):
         return input_shape[0]
@@ -91,13 +119,14 @@ class NeuralAttention(Layer):
         x = input  # notation consistency
 
         # First two dense layers with linear activation
-        gamma = K.dot(x, self.kernel_x)
+        gamma = timestep_dot(x, self.kernel_x, self.n_timespans)
         if self.use_bias:
             gamma = K.bias_add(gamma, self.bias_x)
         gamma = K.tanh(gamma)
 
         # Dense layer with softmax activation (no bias needed)
-        alpha = softmax(K.dot(gamma, self.kernel_a), axis=-2)
+        alpha = softmax(timestep_dot(gamma, self.kernel_a, self.n_timespans),
+                        axis=-2)
 
         return alpha
 
@@ -179,8 +208,8 @@ class TimespanGuidedNeuralAttention(Layer):
         x, t = inputs[0], inputs[1]  # define input
 
         # First two dense layers with linear activation
-        gamma = K.dot(x, self.kernel_x)
-        beta = K.dot(t, self.kernel_t)
+        gamma = timestep_dot(x, self.kernel_x, self.n_timespans)
+        beta = timestep_dot(t, self.kernel_t, self.n_timespans)
         if self.use_bias:
             gamma = K.bias_add(gamma, self.bias_x)
             beta = K.bias_add(beta, self.bias_t)
@@ -192,7 +221,8 @@ class TimespanGuidedNeuralAttention(Layer):
         delta = ConvexCombination()([gamma, beta])
 
         # Dense layer with softmax activation (no bias needed)
-        alpha = softmax(K.dot(delta, self.kernel_a), axis=-2)
+        alpha = softmax(timestep_dot(delta, self.kernel_a, self.n_timespans),
+                        axis=-2)
 
         return alpha
 
@@ -3,18 +3,29 @@
 from __future__ import division, print_function
 
 import warnings
-from collections import Counter
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from mbspbs10pc.utils import flatten
-
 __C0C1_THRESH__ = 0.75
+__DTYPES__ = {'PTNT_ID': np.int64,
+              'PTNT_CTGRY_DRVD_CD': 'category'}  # few distinct categories
+
+
+def _find_c0c1(pbs):
+    """Find the unique PTNT_ID of the subjects using C0 or C1 in a PBS file."""
+    with warnings.catch_warnings():  # ignore FutureWarning
+        warnings.simplefilter(action='ignore', category=FutureWarning)
+        df = pd.read_csv(pbs, header=0, engine='c',
+                         usecols=['PTNT_ID', 'PTNT_CTGRY_DRVD_CD'],
+                         dtype=__DTYPES__)
+    _c0c1 = df.loc[df['PTNT_CTGRY_DRVD_CD'].isin(['C0', 'C1'])]['PTNT_ID']
+    return np.unique(_c0c1.values)
 
 
-def find_continuously_concessionals(pbs_files):
+def find_continuously_concessionals(pbs_files, n_jobs=4):
     """"Find continuously concessionals.
 
     Find subjects that are using concessional cards for at least 75% of the
@@ -25,33 +36,46 @@ def find_continuously_concessionals(pbs_files):
     pbs_files: list
         List of input PBS filenames.
 
+    n_jobs: integer
+        The number of processes that scan the input files in parallel.
+
     Returns:
     --------------
     idx: set
         The set of PTNT_IDs after the filtering step.
     """
-    c0c1 = []  # init as empty list
-
-    with warnings.catch_warnings():  # ignore FutureWarning
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        # scan the PBS files and select only the two columns of interest and save
-        # the unique PTNT_ID of the subjects using C0 or C1 in the current year
-        for pbs in tqdm(pbs_files, leave=False):
-            df = pd.read_csv(pbs, header=0,
-                             usecols=['PTNT_ID', 'PTNT_CTGRY_DRVD_CD'])
-            _c0c1 = df.loc[df['PTNT_CTGRY_DRVD_CD'].isin(['C0', 'C1'])]['PTNT_ID']
-            c0c1.append(np.unique(_c0c1.values))
-    c0c1 = flatten(c0c1)
-
-    # then count the number of times an index appears
-    c0c1_counts = pd.DataFrame.from_dict(Counter(c0c1), orient='index').rename({0: 'COUNTS'}, axis=1)
+    # scan the PBS files (one per process) and select only the two columns of
+    # interest and save the unique PTNT_ID of the subjects using C0 or C1 in
+    # the current year
+    c0c1 = Parallel(n_jobs=n_jobs)(delayed(_find_c0c1)(pbs)
+                                   for pbs in tqdm(pbs_files, leave=False))
+
+    # then count the number of times an index appears (i.e. the number of
+    # years) in a single pass over the concatenated identifiers
+    c0c1_counts = pd.Series(np.concatenate(c0c1)).value_counts()
     # return only the subjects that use concessional cards for at least
     # 50% of the years of observation
-    idx = c0c1_counts[c0c1_counts['COUNTS'] > __C0C1_THRESH__*len(pbs_files)].index.tolist()
+    idx = c0c1_counts.index[c0c1_counts.values > __C0C1_THRESH__*len(pbs_files)]
     return set(idx)
 
 
-def find_consistently_concessionals(pbs_files):
+def _find_consistent(pbs):
+    """Find the PTNT_ID of the subjects mostly using C0 or C1 in a PBS file."""
+    with warnings.catch_warnings():  # ignore FutureWarning
+        warnings.simplefilter(action='ignore', category=FutureWarning)
+        df = pd.read_csv(pbs, header=0, engine='c',
+                         usecols=['PTNT_ID', 'PTNT_CTGRY_DRVD_CD'],
+                         dtype=__DTYPES__)
+    # flag the PBS items of the subjects using C0 or C1 and calculate the
+    # concessional card usage ratio of each PTNT_ID in one groupby
+    c0c1 = df['PTNT_CTGRY_DRVD_CD'].isin(['C0', 'C1']).astype(float)
+    usage = c0c1.groupby(df['PTNT_ID'].values).mean()
+
+    # and keep only the PTNT_ID that use it for at least 75% of the times
+    return usage.index[usage.values >= __C0C1_THRESH__].values
+
+
+def find_consistently_concessionals(pbs_files, n_jobs=4):
     """Find consistently concessionals.
 
     Find subjects that use their concessional cards for at least 75% of the PBS
@@ -62,40 +86,22 @@ def find_consistently_concessionals(pbs_files):
     pbs_files: list
         List of input PBS filenames.
 
+    n_jobs: integer
+        The number of processes that scan the input files in parallel.
+
     Returns:
     --------------
     idx: set
         The PTNT_IDs after the filtering step.
     """
-    idx = set()  # init the output as an empty set
-
-    with warnings.catch_warnings():  # ignore FutureWarning
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        # scan the PBS files and select only the two columns of interest
-        for pbs in tqdm(pbs_files, leave=False):
-            df = pd.read_csv(pbs, header=0,
-                             usecols=['PTNT_ID', 'PTNT_CTGRY_DRVD_CD'])
-            # count the number of PBS items of each PTNT_ID
-            df_counter = Counter(df['PTNT_ID'].values)
-
-            # now keep only the PTNT_ID of the subjects using C0 or C1 and count
-            # the number of PBS items each
-            c0c1 = df.loc[df['PTNT_CTGRY_DRVD_CD'].isin(['C0', 'C1'])]
-            c0c1_counter = Counter(c0c1['PTNT_ID'].values)
-
-            # now calculate the concessional card usage ratio
-            usage = {}
-            for k in c0c1_counter.keys():
-                usage[k] = c0c1_counter[k] / df_counter[k]
-            usage_df = pd.DataFrame.from_dict(usage, orient='index').rename({0: 'COUNTS'}, axis=1)
-
-            # and keep only the PTNT_ID that use it for at least 75% of the times
-            usage_df = usage_df[usage_df['COUNTS'] >= __C0C1_THRESH__]
-
-            # add them to the output set
-            for i in usage_df.index: # FIXME find a way to avoid nested loops
-                idx.add(i)
+    # scan the PBS files (one per process) and select only the two columns of
+    # interest and the consistently concessional subjects of each year
+    cons = Parallel(n_jobs=n_jobs)(delayed(_find_consistent)(pbs)
+                                   for pbs in tqdm(pbs_files, leave=False))
 
     # return all the unique identifiers PTNT_ID that consistently used their
     # concessional cards for at least one observation year
+    idx = set()  # init the output as an empty set
+    for _cons in cons:
+        idx.update(_cons)
     return idx
@@ -2,12 +2,45 @@
 import os
 import warnings
 
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from mbspbs10pc import __path__ as home
+from mbspbs10pc.utils import parse_dates
 from tqdm import tqdm
 
 warnings.filterwarnings('ignore')
 
+__ITEMS__ = {}  # items loaded from the data folder (one read per process)
+
+
+def _load_items(filename, fix_notation=False):
+    """Load a set of items from the data folder.
+
+    Each file is read only once, then the cached items are returned. The items
+    are stored as an array, as isin() would convert a set at each call.
+
+    Parameters:
+    --------------
+    filename: string
+        The csv file name in the data folder.
+
+    fix_notation: bool
+        Convert the items to the 6-digit notation.
+
+    Returns:
+    --------------
+    items: array
+        The unique items.
+    """
+    if filename not in __ITEMS__:
+        items = pd.read_csv(os.path.join(home[0], 'data', filename),
+                            header=0).values.ravel()
+        if fix_notation:  # zero-pad the items to 6 digits
+            items = pd.Series(items).astype(str).str.zfill(6).values
+        __ITEMS__[filename] = pd.unique(np.asarray(items, dtype=object))
+    return __ITEMS__[filename]
+
 
 def find_others(dd, met_idx):
     """Find the people that changed from metformin to other drugs.
@@ -28,19 +61,81 @@ def find_others(dd, met_idx):
     end_date: list
         The first non-metformin prescription.
     """
-    ids = dd['PTNT_ID']
-    idx = set(ids) - set(met_idx)
+    idx = set(dd['PTNT_ID']) - set(met_idx)
 
-    grouped = dd.groupby(by='PTNT_ID')
-    filtered = grouped.filter(lambda x: x['PTNT_ID'].values[0] in idx).groupby(by='PTNT_ID')
+    # Build output variables (one aggregation over all the selected patients)
+    supply = dd[dd['PTNT_ID'].isin(idx).values].groupby(by='PTNT_ID')['SPPLY_DT']
+    first_supply, last_supply = supply.min(), supply.max()
+    idx = first_supply.index.tolist()
+    start_date = first_supply.dt.strftime('%Y-%m-%d').tolist()
+    end_date = last_supply.dt.strftime('%Y-%m-%d').tolist()
 
-    # Init return items
-    start_date, end_date = list(), list()
+    return idx, start_date, end_date
 
-    # Build output variables
-    for name, group in tqdm(filtered, desc='Finalizing', leave=False):
-        start_date.append(group['SPPLY_DT'].min().strftime('%Y-%m-%d'))
-        end_date.append(group['SPPLY_DT'].max().strftime('%Y-%m-%d'))
+
+def _flag_prescriptions(dd, min_metformin, metonly, metx):
+    """Flag each prescription of the patients sorted by supply date.
+
+    Parameters:
+    --------------
+    dd: pandas.DataFrame
+        The output of find_diabetics().
+
+    min_metformin: int
+        Number of initial prescriptions flagged as head.
+
+    metonly: set
+        Metformin ONLY items.
+
+    metx: set
+        Metformin + other drug items.
+
+    Returns:
+    --------------
+    flags: pandas.DataFrame
+        Table with `'PTNT_ID'`, `'SPPLY_DT'` and the boolean columns `'HEAD'`
+        (first `min_metformin` prescriptions), `'MET'` and `'METX'`.
+    """
+    df = dd.sort_values(by=['PTNT_ID', 'SPPLY_DT'])
+    position = df.groupby(by='PTNT_ID').cumcount().values
+    return pd.DataFrame({'PTNT_ID': df['PTNT_ID'].values,
+                         'SPPLY_DT': df['SPPLY_DT'].values,
+                         'HEAD': position < min_metformin,
+                         'MET': df['ITM_CD'].isin(metonly).values,
+                         'METX': df['ITM_CD'].isin(metx).values})
+
+
+def _switch_dates(flags, mask):
+    """Get first prescription and first non-metformin prescription dates.
+
+    Parameters:
+    --------------
+    flags: pandas.DataFrame
+        The output of _flag_prescriptions().
+
+    mask: pandas.Series
+        Boolean mask indexed by `'PTNT_ID'`.
+
+    Returns:
+    --------------
+    idx: list
+        `'PTNT_ID'` of the selected people.
+
+    start_date: list
+        The first metformin prescription.
+
+    end_date: list
+        The first non-metformin prescription.
+    """
+    selected = flags[flags['PTNT_ID'].isin(mask.index[mask.values]).values]
+    first_supply = selected.groupby(by='PTNT_ID')['SPPLY_DT'].min()
+    # get the non metformins
+    first_nonmet = selected[~selected['MET'].values].groupby(by='PTNT_ID')['SPPLY_DT'].min()
+    first_nonmet = first_nonmet.loc[first_supply.index]
+
+    idx = first_supply.index.tolist()
+    start_date = first_supply.dt.strftime('%Y-%m-%d').tolist()
+    end_date = first_nonmet.dt.strftime('%Y-%m-%d').tolist()
 
     return idx, start_date, end_date
 
@@ -68,42 +163,22 @@ def find_met2x(dd, min_metformin=1):
         The first non-metformin prescription.
     """
     # Load the metformin items
-    metonly = set(pd.read_csv(os.path.join(home[0], 'data', 'metformin_items.csv'),
-                  header=0).values.ravel())
-    metx = set(pd.read_csv(os.path.join(home[0], 'data', 'metformin+x_items.csv'),
-                  header=0).values.ravel())
+    metonly = _load_items('metformin_items.csv')
+    metx = _load_items('metformin+x_items.csv')
 
-    def condition(group):
-        if len(group) <= min_metformin:
-            return False
-        else:
-            sorted_group = group.sort_values(by='SPPLY_DT')
-            head = set(sorted_group.head(min_metformin)['ITM_CD'].values) # these must all be metformin
-            tail = set(sorted_group.tail(-min_metformin)['ITM_CD'].values) # there should be NO metformin in here
+    flags = _flag_prescriptions(dd, min_metformin, metonly, metx)
+    head, tail = flags['HEAD'], ~flags['HEAD']
+    pins = flags['PTNT_ID'].values
 
-            cond1 = head.issubset(metonly)
-            cond2 = len(tail.intersection(metonly)) == 0
-            cond3 = len(tail.intersection(metx)) == 0
+    # (boolean min/max are the cythonized equivalents of all/any)
+    # these must all be metformin
+    cond1 = (~head | flags['MET']).groupby(pins).min()
+    # there should be NO metformin in the tail
+    cond2 = ~(tail & flags['MET']).groupby(pins).max()
+    cond3 = ~(tail & flags['METX']).groupby(pins).max()
+    long_enough = tail.groupby(pins).max()  # more than min_metformin items
 
-            return cond1 and cond2 and cond3
-
-    grouped = dd.groupby(by='PTNT_ID')
-    filtered = grouped.filter(condition).groupby(by='PTNT_ID')
-
-    # Init return items
-    idx, start_date, end_date = list(), list(), list()
-
-    # Build output variables
-    for name, group in tqdm(filtered, desc='Finalizing', leave=False):
-        idx.append(name)
-        sorted_group = group.sort_values(by='SPPLY_DT')
-        # first date FIXME: max() added for consistency
-        start_date.append(sorted_group.head(1)['SPPLY_DT'].max().strftime('%Y-%m-%d'))
-        # get the non metformins
-        filtered_group = sorted_group[~sorted_group['ITM_CD'].isin(metonly)]
-        end_date.append(filtered_group['SPPLY_DT'].min().strftime('%Y-%m-%d'))
-
-    return idx, start_date, end_date
+    return _switch_dates(flags, long_enough & cond1 & cond2 & cond3)
 
 
 def find_metx(dd, min_metformin=1):
@@ -132,45 +207,24 @@ def find_metx(dd, min_metformin=1):
         The first non-metformin prescription.
     """
     # Load the metformin items
-    metonly = set(pd.read_csv(os.path.join(home[0], 'data', 'metformin_items.csv'),
-                  header=0).values.ravel())
-    metx = set(pd.read_csv(os.path.join(home[0], 'data', 'metformin+x_items.csv'),
-                  header=0).values.ravel())
-
-    def condition(group):
-        """Filtering condition."""
-        if len(group) <= min_metformin:
-            return False
-        else:
-            sorted_group = group.sort_values(by='SPPLY_DT')
-            # these must all be metformin for cond1
-            head = set(sorted_group.head(min_metformin)['ITM_CD'].values)
-            # there should be both in here for cond2
-            tail = set(sorted_group.tail(-min_metformin)['ITM_CD'].values)
-            # implementing conditions
-            cond1 = head.issubset(metonly)
-            cond2 = len(tail.intersection(metonly)) > 0 and len(tail.intersection(metonly)) < len(tail)
-            # handling special case of met+x items introduced after 2014
-            cond3 = len(tail.intersection(metx)) > 0
-            return cond1 and (cond2 or cond3)
-
-    grouped = dd.groupby(by='PTNT_ID')
-    filtered = grouped.filter(condition).groupby(by='PTNT_ID')
-
-    # Init return items
-    idx, start_date, end_date = list(), list(), list()
+    metonly = _load_items('metformin_items.csv')
+    metx = _load_items('metformin+x_items.csv')
 
-    # Build output variables
-    for name, group in tqdm(filtered, desc='Finalizing', leave=False):
-        idx.append(name)
-        sorted_group = group.sort_values(by='SPPLY_DT')
-        # first date FIXME: max() added for consistency
-        start_date.append(sorted_group.head(1)['SPPLY_DT'].max().strftime('%Y-%m-%d'))
-        # get the non metformins
-        filtered_group = sorted_group[~sorted_group['ITM_CD'].isin(metonly)]
-        end_date.append(filtered_group['SPPLY_DT'].min().strftime('%Y-%m-%d'))
+    flags = _flag_prescriptions(dd, min_metformin, metonly, metx)
+    head, tail = flags['HEAD'], ~flags['HEAD']
+    pins = flags['PTNT_ID'].values
 
-    return idx, start_date, end_date
+    # (boolean min/max are the cythonized equivalents of all/any)
+    # these must all be metformin for cond1
+    cond1 = (~head | flags['MET']).groupby(pins).min()
+    # there should be both metformin and non-metformin in the tail for cond2
+    cond2 = (tail & flags['MET']).groupby(pins).max() & \
+        (tail & ~flags['MET']).groupby(pins).max()
+    # handling special case of met+x items introduced after 2014
+    cond3 = (tail & flags['METX']).groupby(pins).max()
+    long_enough = tail.groupby(pins).max()  # more than min_metformin items
+
+    return _switch_dates(flags, long_enough & cond1 & (cond2 | cond3))
 
 
 def find_metonly(dd):
@@ -194,25 +248,44 @@ def find_metonly(dd):
         The last day of the last observation year (2014).
     """
     # Load the metformin items
-    metonly = set(pd.read_csv(os.path.join(home[0], 'data', 'metformin_items.csv'),
-                  header=0).values.ravel())
-
-    # Filter the metformin only
-    filtered = dd.groupby(by='PTNT_ID').filter(lambda x: set(x['ITM_CD']).issubset(metonly)).groupby(by='PTNT_ID')
+    metonly = _load_items('metformin_items.csv')
 
-    # Init return items
-    idx, start_date, end_date = list(), list(), list()
+    # Filter the metformin only (flag each prescription, then check per patient)
+    is_met = dd['ITM_CD'].isin(metonly)
+    # (min is the cythonized equivalent of all on booleans)
+    metonly_mask = is_met.groupby(dd['PTNT_ID'].values).min()
+    idx = metonly_mask.index[metonly_mask.values]
 
     # Build output variables
-    for name, group in tqdm(filtered, desc='Finalizing', leave=False):
-        idx.append(name)
-        start_date.append(group['SPPLY_DT'].min().strftime('%Y-%m-%d'))
-        end_date.append('2014-12-31')
+    first_supply = dd.groupby(by='PTNT_ID')['SPPLY_DT'].min().loc[idx]
+    start_date = first_supply.dt.strftime('%Y-%m-%d').tolist()
+    end_date = ['2014-12-31'] * len(idx)
+    idx = idx.tolist()
 
     return idx, start_date, end_date
 
 
-def find_diabetics(pbs_files, ccc=set()):
+def _find_diabetics(pbs, ccc, chunksize):
+    """Find the records of ccc using diabetes drugs in a PBS file."""
+    # each process loads the drugs used in diabetes list file only once
+    dd = _load_items('drugs_used_in_diabetes.csv', fix_notation=True)
+
+    columns = ['ITM_CD', 'PTNT_ID', 'SPPLY_DT']
+    reader = pd.read_csv(pbs, header=0, engine='c', usecols=columns,
+                         dtype={'ITM_CD': str, 'PTNT_ID': np.int64,
+                                'SPPLY_DT': str}, chunksize=chunksize)
+    # filter the file chunk by chunk, so that only the selected records are
+    # kept in memory
+    parts = []
+    for chunk in reader:
+        chunk = chunk[chunk['PTNT_ID'].isin(ccc)]  # keep only ccc
+        parts.append(chunk[chunk['ITM_CD'].isin(dd)])  # keep only diabetics
+    pbs_df = pd.concat(parts)
+    pbs_df['SPPLY_DT'] = parse_dates(pbs_df['SPPLY_DT'].values)
+    return pbs_df
+
+
+def find_diabetics(pbs_files, ccc=set(), n_jobs=4, chunksize=200000):
     """Search people using diabetes drugs in input PBS files.
 
     Parameters:
@@ -223,32 +296,26 @@ def find_diabetics(pbs_files, ccc=set()):
     ccc: set
         Set of continuoly and consistently concessional subjects.
 
+    n_jobs: integer
+        The number of processes that scan the input files in parallel.
+
+    chunksize: integer
+        The number of rows of each PBS file read and filtered at once.
+
     Returns:
     --------------
     df: pandas.DataFrame
         Table containing only the records of ccc using diabetics drugs.
     """
-    # Load the drugs used in diabetes list file
-    _dd = pd.read_csv(os.path.join(home[0], 'data', 'drugs_used_in_diabetes.csv'),
-                      header=0)
-
-    # Fix 6-digit notation
-    dd = set()  # dd should be a set for performance reasons
-    for item in _dd.values.ravel():
-        if len(item) < 6:
-            dd.add(str(0)+item)
-        else:
-            dd.add(item)
-
-    # Find the ccc diabetics and save them in a single data frame
-    columns = ['ITM_CD', 'PTNT_ID', 'SPPLY_DT']
-    df = pd.DataFrame(columns=columns)
-    for pbs in tqdm(pbs_files, desc='PBS files loading', leave=False):
-        pbs_df = pd.read_csv(pbs, header=0, engine='c',
-                             usecols=columns)
-        pbs_df = pbs_df[pbs_df['PTNT_ID'].isin(ccc)]  # keep only ccc
-        pbs_df = pbs_df[pbs_df['ITM_CD'].isin(dd)]  # keep only diabetics
-        df = pd.concat((df, pbs_df))
-    df.loc[:, 'SPPLY_DT'] = pd.to_datetime(df['SPPLY_DT'], format='%d%b%Y')
+    # isin() converts sets to arrays at each call: convert ccc only once
+    ccc = np.array(list(ccc))
+
+    # Find the ccc diabetics (one file per process) and save them in a single
+    # data frame
+    parts = Parallel(n_jobs=n_jobs)(
+        delayed(_find_diabetics)(pbs, ccc, chunksize)
+        for pbs in tqdm(pbs_files, desc='PBS files loading', leave=False))
+    df = pd.concat(parts)
+    df['ITM_CD'] = df['ITM_CD'].astype('category')  # few distinct items
 
     return df
@@ -3,14 +3,19 @@ from __future__ import division, print_function
 
 import datetime
 import os
+from functools import partial
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from mbspbs10pc import __path__ as home
-from mbspbs10pc.concessionals_utils import flatten
+from mbspbs10pc.utils import parse_dates
 from tqdm import tqdm
 
 MIN_SEQ_LENGTH = 10  # threshold for the minimum sequence length
+# upper bounds (in days) of the timespan encodings (using the "business"
+# month and year durations)
+TIMESPAN_BOUNDS = np.array([14, 30, 90, 360])
 
 
 def timespan_encoding(days):
@@ -29,27 +34,83 @@ def timespan_encoding(days):
 
     Parameters:
     --------------
-    days: int
+    days: int or array-like
         The number of days between any two examinations.
 
     Returns:
     --------------
-    enc: string
+    enc: string or array of strings
         The corresponding encoding.
     """
-    if days < 0:
+    days = np.asarray(days)
+    if np.any(days < 0):
         raise ValueError('Unsupported negative timespans')
-    elif days >= 0 and days <= 14:
-        enc = 0
-    elif days > 14 and days <= 30:  # using the "business" month duration
-        enc = 1
-    elif days > 30 and days <= 90:  # using the "business" month duration
-        enc = 2
-    elif days > 90 and days <= 360:  # using the "business" year duration
-        enc = 3
+    # upper bounds are inclusive, hence side='left'
+    enc = np.searchsorted(TIMESPAN_BOUNDS, days, side='left').astype(str)
+    return enc if enc.ndim else str(enc)
+
+
+def extract_sequence(group, info):
+    """Extract sequence from group of MBS items.
+
+    This function, in order to be applied to pandas groups, must be wrapped by
+    `functools.partial`. For parallel application see `_extract_sequences`,
+    which is dispatched to the workers by `get_raw_data`.
+
+    Parameters:
+    --------------
+    group: pandas.DataFrame
+        The MBS items of a single PIN, sorted by DOS.
+
+    info: dict
+        Having `['START_DATE', 'END_DATE', 'YOB', 'SEX']` as keys, each one
+        mapping a PIN to the corresponding value.
+
+    Returns:
+    --------------
+    out: pandas.Series
+        Having `['seq', 'avg_age', 'last_pinstate', 'sex']` as index.
+    """
+    pin = group.PIN.values[0]  # extract the current PIN
+    start_date = info['START_DATE'][pin]  # get start date
+    end_date = info['END_DATE'][pin]  # get end date
+    # select sequence timespan (the group is sorted by DOS, so just slice it)
+    dos = group['DOS'].values
+    start = np.searchsorted(dos, start_date, side='left')
+    end = np.searchsorted(dos, end_date, side='right')
+    tmp = group.iloc[start:end]
+    if tmp.shape[0] > MIN_SEQ_LENGTH:  # keep only non-trivial sequencences
+        # get the first order difference (in days) of the selected exams
+        timedeltas = tmp['DAYS'].values[1:]
+        # then build the sequence as ['exam', idle-days, 'exam', idle-days, ...]
+        # by interleaving exams (even positions) and idle days (odd positions)
+        items = tmp['ITEM'].values
+        seq = np.empty(2 * len(items) - 1, dtype=object)
+        seq[0::2] = items
+        seq[1::2] = timedeltas
+        # and finally collapse everything down to a string like '213 0 66520 5...'
+        seq = ' '.join(seq.astype(str))
+        # compute the average age during the treatment by computing the average year
+        avg_age = np.mean(pd.DatetimeIndex(tmp['DOS'].values.ravel()).year)  - info['YOB'][pin]
+        # extract the last pinstate
+        last_pinstate = tmp['PINSTATE'].values.ravel()[-1]
+        # extract gender
+        sex = info['SEX'][pin]
     else:
-        enc = 4
-    return str(enc)
+        seq, avg_age, last_pinstate, sex = np.nan, np.nan, np.nan, np.nan
+
+    return pd.Series({'seq': seq, 'avg_age': avg_age, 'last_pinstate': last_pinstate, 'sex': sex})
+
+
+def _extract_sequences(mbs_df, dfs):
+    """Extract the sequences of all the PINs in the input MBS items.
+
+    The info of each PIN is taken from `dfs` (see `get_raw_data`) and mapped
+    with plain dictionaries (a single hash lookup per group).
+    """
+    info = {col: dict(zip(dfs.index, dfs[col].values))
+            for col in ['START_DATE', 'END_DATE', 'YOB', 'SEX']}
+    return mbs_df.groupby('PIN').apply(partial(extract_sequence, info=info))
 
 
 def get_raw_data(mbs_files, sample_pin_lookout, exclude_pregnancy=False, source=None, n_jobs=4):
@@ -75,7 +136,7 @@ def get_raw_data(mbs_files, sample_pin_lookout, exclude_pregnancy=False, source=
         Location of the 'PTNT_ID' csv file generated by `labels_assignment.py`.
 
     n_jobs: integer
-        The number of processes that have asyncronous access to the input files.
+        The number of processes used to extract the sequences.
 
     Returns:
     --------------
@@ -106,48 +167,41 @@ def get_raw_data(mbs_files, sample_pin_lookout, exclude_pregnancy=False, source=
     # at first create a very large DataFrame with all the MBS files
     # (keeping only the relevant columns)
     # It is possible here to exclude pregnant subjects
-    mbs_df = pd.DataFrame(columns=['PIN', 'ITEM', 'DOS', 'PINSTATE'])
+    # (the filtered files are concatenated once at the end)
+    mbs_parts = []
     for mbs in tqdm(mbs_files, desc='MBS files loading', leave=False):
-        dd = pd.read_csv(mbs, header=0, usecols=['PIN', 'ITEM', 'DOS', 'PINSTATE'], engine='c')
+        dd = pd.read_csv(mbs, header=0, usecols=['PIN', 'ITEM', 'DOS', 'PINSTATE'], engine='c',
+                         dtype={'PIN': np.int64, 'ITEM': np.int32})
         if exclude_pregnancy: dd = dd.loc[~dd['ITEM'].isin(pregnancy_items), :]
         dd = dd.loc[dd['PIN'].isin(dfs.index), :]  # keep only the relevant samples
         dd = pd.merge(dd, btos4d, how='left', on='ITEM') # get the BTOS4D TODO:DELETE
-        mbs_df = pd.concat((mbs_df, dd))
-    mbs_df.loc[:, 'DOS'] = pd.to_datetime(mbs_df['DOS'], format='%d%b%Y')
-
-    # Group by PIN (skip empty groups)
-    grouped = mbs_df.groupby('PIN').filter(lambda x: len(x) > 1).groupby('PIN')
-
-    def extract_sequence(group): # the variable dfs is local here
-        """Extract sequence from group of MBS items.
-
-        This function, in order to be applied to pandas groups, must be wrapped by
-        `functools.partial`. For parallel application see `mbspbs10pc.utils.applyParallel`.
-        """
-        pin = group.PIN.values[0]  # extract the current PIN
-        tmp = group.sort_values(by='DOS')  # sort by DOS
-        start_date = dfs.loc[pin]['START_DATE']  # get start date
-        end_date = dfs.loc[pin]['END_DATE']  # get end date
-        # select sequence timespan
-        tmp = tmp.loc[np.logical_and(tmp['DOS'] >= start_date, tmp['DOS'] <= end_date), :]
-        if tmp.shape[0] > MIN_SEQ_LENGTH:  # keep only non-trivial sequencences
-            # evaluate the first order difference and convert each entry in WEEKS
-            timedeltas = map(lambda x: pd.Timedelta(x).days,
-                             tmp['DOS'].values[1:] - tmp['DOS'].values[:-1])
-            # then build the sequence as ['exam', idle-days, 'exam', idle-days, ...]
-            seq = flatten([[item, dt] for item, dt in zip(tmp['ITEM'].values, timedeltas)])
-            seq.append(tmp['ITEM'].values.ravel()[-1])  # add the last exam (ignored by zip)
-            # and finally collapse everything down to a string like '213 0 66520 5...'
-            seq = ' '.join(map(str, seq))
-            # compute the average age during the treatment by computing the average year
-            avg_age = np.mean(pd.DatetimeIndex(tmp['DOS'].values.ravel()).year)  - dfs.loc[pin]['YOB']
-            # extract the last pinstate
-            last_pinstate = tmp['PINSTATE'].values.ravel()[-1]
-            # extract gender
-            sex = dfs.loc[pin]['SEX']
-        else:
-            seq, avg_age, last_pinstate, sex = np.nan, np.nan, np.nan, np.nan
-
-        return pd.Series({'seq': seq, 'avg_age': avg_age, 'last_pinstate': last_pinstate, 'sex': sex})
-
-    return grouped.apply(extract_sequence).dropna()
+        mbs_parts.append(dd)
+    mbs_df = pd.concat(mbs_parts, ignore_index=True, copy=False)
+    mbs_df['PINSTATE'] = mbs_df['PINSTATE'].astype('category')  # few distinct states
+    mbs_df['DOS'] = parse_dates(mbs_df['DOS'].values)
+
+    # Sort by PIN and DOS once and evaluate the idle days between consecutive
+    # exams in a single pass (the first entry of each PIN is never used)
+    mbs_df = mbs_df.sort_values(by=['PIN', 'DOS']).reset_index(drop=True)
+    days = np.diff(mbs_df['DOS'].values).astype('timedelta64[D]').astype(np.int64)
+    mbs_df['DAYS'] = np.concatenate(([0], days))
+
+    # Parse the sequence extraction dates once
+    dfs['START_DATE'] = pd.to_datetime(dfs['START_DATE'])
+    dfs['END_DATE'] = pd.to_datetime(dfs['END_DATE'])
+
+    # Skip the PINs having a single exam (vectorized, no per-group callback)
+    mbs_df = mbs_df[mbs_df['PIN'].duplicated(keep=False).values]
+    if mbs_df.empty:  # nothing to extract (and nothing to concatenate)
+        return pd.DataFrame(columns=['seq', 'avg_age', 'last_pinstate', 'sex'],
+                            index=pd.Index([], name='PIN'))
+
+    # Extract the sequences in parallel, each process working on a contiguous
+    # range of PINs (mbs_df is sorted by PIN) and receiving only their info
+    pins = pd.factorize(mbs_df['PIN'])[0]
+    chunks = pins * n_jobs // max(1, len(np.unique(pins)))
+    raw_data = pd.concat(Parallel(n_jobs=n_jobs)(
+        delayed(_extract_sequences)(chunk, dfs.loc[np.unique(chunk['PIN'].values)])
+        for _, chunk in mbs_df.groupby(chunks)))
+
+    return raw_data.dropna()
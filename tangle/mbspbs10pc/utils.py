@@ -4,17 +4,15 @@ from __future__ import division
 
 import os
 import warnings
-from collections import Counter
+from collections import Counter, OrderedDict
 from multiprocessing import cpu_count
 
 import joblib as jl
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
-from keras.preprocessing.sequence import pad_sequences
 from keras.preprocessing.text import Tokenizer
-from sklearn.model_selection import StratifiedShuffleSplit
+from sklearn.model_selection import train_test_split
 
 
 def flatten(x):
@@ -23,6 +21,31 @@ def flatten(x):
         if type(x) in (list, np.ndarray) else [x]
 
 
+def parse_dates(dates, date_format='%d%b%Y'):
+    """Convert date strings to datetime parsing each distinct date only once.
+
+    The MBS-PBS files only have a few hundreds distinct dates per year, hence
+    parsing the unique values and mapping them back is much faster than
+    parsing every entry.
+
+    Parameters:
+    --------------
+    dates: array-like
+        Input date strings.
+
+    date_format: string (default='%d%b%Y')
+        The strftime format of the input dates.
+
+    Returns:
+    --------------
+    parsed: pandas.DatetimeIndex
+        The parsed dates (missing values are mapped to NaT).
+    """
+    codes, uniques = pd.factorize(dates)
+    return pd.to_datetime(uniques, format=date_format).take(codes,
+                                                            fill_value=pd.NaT)
+
+
 def check_input(root):
     """Check the input dataset."""
     yrange = range(2008, 2015)
@@ -64,6 +87,8 @@ def show_most_frequent(x, top_k=25, dpi=100, column=None, **kwargs):
     dpi    - int, dots per inch of the figure
     kwargs - dict, arguments passed to plt.figure
     """
+    import matplotlib.pyplot as plt  # needed only here, it is slow to import
+
     if column is None: column = 'Counts'
 
     cc = Counter(x)
@@ -100,22 +125,43 @@ def load_data_labels(data_filename, labels_filename):
     Returns:
     --------------
     dataset: pandas.DataFrame
-        Input data.
+        Input data, where `mbs_seq` and `times_seq` are the lists of MBS items
+        and timespans tokens of each sequence.
     """
     labels = pd.read_csv(labels_filename, header=0).rename(
         {'Unnamed: 0': 'PIN'}, axis=1)[['PIN', 'CLASS']].set_index('PIN')
 
     data_pkl = jl.load(open(data_filename, 'rb')).loc[labels.index, 'seq']
-    dataset = pd.DataFrame(columns=['Seq', 'Class'], index=labels.index)
-    dataset.loc[:, 'Seq'] = data_pkl
-    dataset.loc[:, 'Class'] = labels['CLASS']
-    for idx in dataset.index:
-        _tmp = dataset.loc[idx, 'Seq'].split(' ')
-        dataset.loc[idx, 'mbs_seq'] = ' '.join(_tmp[::2])
-        dataset.loc[idx, 'times_seq'] = ' '.join(_tmp[1::2])
+
+    # Split each sequence once, then separate items and timespans
+    _tmp = data_pkl.str.split(' ')
+
+    # Build the dataset from whole columns
+    dataset = pd.DataFrame({'Seq': data_pkl,
+                            'Class': labels['CLASS'],
+                            'mbs_seq': _tmp.str[::2],
+                            'times_seq': _tmp.str[1::2]},
+                           columns=['Seq', 'Class', 'mbs_seq', 'times_seq'],
+                           index=labels.index)
     return dataset
 
 
+def _pad_sequences(flat, lengths, maxlen, value, dtype):
+    """Pad the concatenated sequences with a single vectorized assignment.
+
+    Same as keras `pad_sequences(..., padding='pre', truncating='pre')` on the
+    sequences obtained splitting `flat` according to `lengths`, but without
+    building the sequences one by one.
+    """
+    padded = np.full((len(lengths), maxlen), value, dtype=dtype)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    # distance of each element from the end of its own sequence
+    from_end = np.repeat(np.cumsum(lengths), lengths) - np.arange(len(flat))
+    keep = from_end <= maxlen  # keep only the last maxlen elements
+    padded[rows[keep], maxlen - from_end[keep]] = flat[keep]
+    return padded
+
+
 def tokenize(data, maxlen=250):
     """Tokenize input data.
 
@@ -124,39 +170,51 @@ def tokenize(data, maxlen=250):
     data: pandas.DataFrame
         The DataFrame created by `load_data_labels`.
 
-    maxlen: int
-        Maximum length of all sequences (see `pad_sequences`).
+    maxlen: int or None
+        Maximum length of all sequences (see keras `pad_sequences`). If None,
+        the 95th percentile of the sequence lengths is used.
 
     Returns:
     --------------
     padded_mbs_seq: array
-        Padded sequence of MBS items.
+        Padded sequence of MBS items (int32).
 
     padded_timespan_seq: array
-        Padded sequence of timespans.
+        Padded sequence of timespans (int16).
 
     tokenizer: keras.preprocessing.text.Tokenizer
         The tokenizer object fit on the input data.
     """
-    # Tokenization
+    # Tokenization: factorize all the MBS items at once, then rank them by
+    # decreasing frequency (ties by first appearance) as keras Tokenizer does
+    # (0 is reserved for padding)
+    tokens = data['mbs_seq']
+    codes, vocabulary = pd.factorize(np.concatenate(tokens.values))
+    counts = np.bincount(codes)
+    order = np.argsort(-counts, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(1, len(order) + 1)
+
+    lengths = tokens.str.len().values
+
+    # Store the vocabulary in a Tokenizer, as if it was fit on the corpus
     tokenizer = Tokenizer(char_level=False, lower=False, split=' ')
-
-    # Fit on corpus and extract tokenized sequences
-    tokenizer.fit_on_texts(data['mbs_seq'])
-    seq = tokenizer.texts_to_sequences(data['mbs_seq'])
+    tokenizer.word_counts = OrderedDict(zip(vocabulary, counts.tolist()))
+    tokenizer.word_index = dict(zip(vocabulary[order], rank[order].tolist()))
+    tokenizer.document_count = len(tokens)
 
     # Pad tokenized sequences (keep only the last maxlen items)
-    # lengths = [len(x) for x in seq]
-    # maxlen = int(np.percentile(lengths, 95))
-    padded_mbs_seq = pad_sequences(seq, maxlen=maxlen, padding='pre',
-                                   truncating='pre', value=0)
-
-    # Pad timespans
-    t_seq = [map(int, data.loc[idx, 'times_seq'].split(' '))
-             for idx in data.index]
-    padded_timespan_seq = pad_sequences(t_seq, maxlen=maxlen,
-                                        padding='pre', truncating='pre',
-                                        value=-1)
+    if maxlen is None:
+        maxlen = int(np.percentile(lengths, 95))
+    padded_mbs_seq = _pad_sequences(rank[codes], lengths, maxlen,
+                                    value=0, dtype=np.int32)
+
+    # Pad timespans (days between visits: int16 is enough and halves the
+    # input size, float16 would not represent them exactly above 2048)
+    timespans = data['times_seq']
+    padded_timespan_seq = _pad_sequences(
+        np.concatenate(timespans.values).astype(np.int16),
+        timespans.str.len().values, maxlen, value=-1, dtype=np.int16)
 
     return padded_mbs_seq, padded_timespan_seq, tokenizer
 
@@ -201,46 +259,29 @@ def train_validation_test_split(data, labels, test_size=0.4,
     test_set: tuple
         Same as `train_set`, but for test set.
     """
-    # Full dataset (force local copy)
+    # Full dataset (the splits below are indexed copies, hence no need to copy
+    # the input arrays); the timespans are reshaped only once, as a view
     y = np.array(labels.values.ravel())
-    X, X_t = data[0].copy(), data[1].copy()
+    X, X_t = data[0], data[1].reshape(data[1].shape[0], data[1].shape[1], 1)
 
     # Learn / Test
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=test_size,
-                                 random_state=random_state0)
-    learn_idx, test_idx = next(sss.split(np.zeros((len(y), 1)), y))
-
-    X_learn, y_learn = X[learn_idx, :], y[learn_idx]
-    X_test, y_test = X[test_idx, :], y[test_idx]
-
-    X_learn_t = X_t[learn_idx, :]
-    X_test_t = X_t[test_idx, :]
+    X_learn, X_test, X_learn_t, X_test_t, y_learn, y_test = train_test_split(
+        X, X_t, y, test_size=test_size, stratify=y, random_state=random_state0)
 
     if verbose:
         print('* {} learn / {} test'.format(len(y_learn), len(y_test)))
 
     # Training / Validation
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=validation_size,
-                                 random_state=random_state1)
-    train_idx, valid_idx = next(sss.split(np.zeros((len(y_learn), 1)), y_learn))
-
-    X_train, y_train = X_learn[train_idx, :], y_learn[train_idx]
-    X_valid, y_valid = X_learn[valid_idx, :], y_learn[valid_idx]
-
-    X_train_t = X_learn_t[train_idx, :]
-    X_valid_t = X_learn_t[valid_idx, :]
+    X_train, X_valid, X_train_t, X_valid_t, y_train, y_valid = train_test_split(
+        X_learn, X_learn_t, y_learn, test_size=validation_size,
+        stratify=y_learn, random_state=random_state1)
 
     if verbose:
         print('* {} training / {} validation'.format(len(y_train),
                                                      len(y_valid)))
     # Packing output
-    train_data = [X_train, X_train_t.reshape(len(y_train), X_t.shape[1], 1)]
-    train_set = (train_data, y_train)
-
-    validation_data = [X_valid, X_valid_t.reshape(len(y_valid), X_t.shape[1], 1)]
-    validation_set = (validation_data, y_valid)
-
-    test_data = [X_test, X_test_t.reshape(len(y_test), X_t.shape[1], 1)]
-    test_set = (test_data, y_test)
+    train_set = ([X_train, X_train_t], y_train)
+    validation_set = ([X_valid, X_valid_t], y_valid)
+    test_set = ([X_test, X_test_t], y_test)
 
     return train_set, validation_set, test_set